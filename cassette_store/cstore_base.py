@@ -4,11 +4,17 @@
 # Base class for cassette_store. All higher calculater/computer specific
 # classes are derived from this.
 # ----
-import io
+import os
+import re
 import subprocess
 import sys
-from collections import deque
-from itertools import islice
+from itertools import chain
+
+# fcntl(2) is only there on Unix. It is used to enlarge the sox(1) pipes.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 CSTORE_PARITY_EVEN  = 0
 CSTORE_PARITY_ODD   = 1
@@ -18,11 +24,47 @@ CSTORE_SOX_SOX      = 'sox'
 CSTORE_SOX_REC      = 'rec'
 CSTORE_SOX_PLAY     = 'play'
 
+CSTORE_BIT_DATA     = 0
+CSTORE_BIT_START    = 1
+CSTORE_BIT_EVEN     = 2
+CSTORE_BIT_ODD      = 3
+CSTORE_BIT_STOP     = 4
+
 CSTORE_SOX_RATE     = 48000
 CSTORE_SOX_BITS     = 8
 CSTORE_SOX_CHANNELS = 1
 CSTORE_SOX_ENCODING = 'signed'
 CSTORE_SOX_TYPE     = 'raw'
+CSTORE_SOX_READSIZE = 64 * 1024
+CSTORE_SOX_PIPESIZE = 1 << 20
+
+CSTORE_OUTPUT_FLUSH = 64 * 1024
+
+# How decoded bytes are shown in debug output. Anything not printable
+# is shown as '.'.
+CSTORE_DBG_BYTE_CHARS = ''.join(c if c.isprintable() else '.'
+                                for c in map(chr, range(256)))
+
+# Translation table reducing a signed 8-bit audio frame to its sign bit
+_SBC_SIGN_TABLE = bytes(b >> 7 for b in range(256))
+
+# Translation table turning classified halfwaves into '#' and '.'
+_HW_CHAR_TABLE = bytes.maketrans(b'\x00\x01', b'#.')
+
+# Linux fcntl(2) command to resize a pipe. Older Pythons don't define
+# the constant in the fcntl module.
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+# Ask the kernel for a larger pipe buffer so that sox(1) and we don't
+# have to wait on each other as often. This is only a hint, so it is
+# fine if the platform doesn't support it or the size is not allowed.
+def _set_pipe_size(fd):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(fd, _F_SETPIPE_SZ, CSTORE_SOX_PIPESIZE)
+    except OSError:
+        pass
 
 class CStoreException(Exception):
     def __init__(self, msg):
@@ -52,13 +94,31 @@ class CStoreBase:
         if debug:
             print("DBG: debug level", debug)
 
+        # Compile the bitpattern into a tuple of (operation, bitmask) so
+        # that encoding and decoding don't have to interpret the pattern
+        # string for every single bit.
+        bitops = []
+        for state in bitpattern:
+            if state in '01234567':
+                bitops.append((CSTORE_BIT_DATA, 1 << int(state)))
+            elif state == 'S':
+                bitops.append((CSTORE_BIT_START, 0))
+            elif state == 'E':
+                bitops.append((CSTORE_BIT_EVEN, 0))
+            elif state == 'O':
+                bitops.append((CSTORE_BIT_ODD, 0))
+            elif state == '-':
+                bitops.append((CSTORE_BIT_STOP, 0))
+        self.bitops = tuple(bitops)
+
         # Generate frame arrays for zero and one bits depending on the
         # base frequency and baud.
         fphw = int(CSTORE_SOX_RATE / basefreq / 2)
         len_0 = int(self.origfreq / self.baud / 2)
         len_1 = int(len_0 * 2)
-        self.frames0 = ([120] * fphw * 2 + [-120 & 0xff] * fphw * 2) * len_0
-        self.frames1 = ([120] * fphw + [-120 & 0xff] * fphw) * len_1
+        self.frames0 = bytes([120] * fphw * 2
+                             + [-120 & 0xff] * fphw * 2) * len_0
+        self.frames1 = bytes([120] * fphw + [-120 & 0xff] * fphw) * len_1
 
         if mode == 'r':
             # This is 'save' mode, reading from the calculator
@@ -92,10 +152,15 @@ class CStoreBase:
                 if sinc is not None:
                     cmd += ['sinc', str(sinc)]
 
-            # Launch the sox(1) process
+            # Launch the sox(1) process. We read the pipe's file descriptor
+            # directly in large chunks, so Python's pipe object does not
+            # need a buffer of its own.
             self.soxproc = subprocess.Popen(cmd, stdout = subprocess.PIPE,
-                                            text = False)
-            self.soxpipe = io.BufferedReader(self.soxproc.stdout)
+                                            text = False,
+                                            bufsize = 0)
+            self.soxpipe = self.soxproc.stdout
+            self.soxfd = self.soxpipe.fileno()
+            _set_pipe_size(self.soxfd)
 
             # Create the generator for sign-bit-changes
             self.sbc    = self._read_sbc_generator()
@@ -111,14 +176,15 @@ class CStoreBase:
 
             # Create all the generators needed
             self.hw         = self._read_hw_generator()
-            self.startbit   = self._read_startbit_generator()
-            self.bits       = self._read_bit_generator()
             self.allbytes   = self._read_byte_generator()
 
-            # Set up the half-wave sample buffer for the _read_hw_generator
+            # Set up the half-wave sample buffer for the _read_hw_generator.
+            # The bit decoding looks at a window of hwlen_1 halfwaves that
+            # starts at hwpos in the hwbuffer.
             self.hwlen_0    = int(self.origfreq / self.baud)
             self.hwlen_1    = self.hwlen_0 * 2
-            self.hwbuffer   = deque(maxlen = self.hwlen_1)
+            self.hwbuffer   = ''
+            self.hwpos      = 0
         elif mode == 'w':
             # This is 'load' mode, writing to the calculator or a sound-file
             if fname is None:
@@ -151,8 +217,20 @@ class CStoreBase:
             if self.debug >= 1:
                 print("DBG: sox cmd =", cmd)
             self.soxproc = subprocess.Popen(cmd, stdin = subprocess.PIPE,
-                                            text = False)
-            self.soxpipe = io.BufferedWriter(self.soxproc.stdin)
+                                            text = False,
+                                            bufsize = 0)
+            self.soxpipe = self.soxproc.stdin
+            self.soxfd = self.soxpipe.fileno()
+            _set_pipe_size(self.soxfd)
+
+            # The bitpattern is fixed, so the complete audio frames for
+            # every possible byte value can be built up front.
+            self.byteframes = tuple(self._encode_byte(b) for b in range(256))
+
+            # Audio frames are collected here and written to the pipe's
+            # file descriptor in chunks of at least CSTORE_OUTPUT_FLUSH
+            # bytes. There is no other buffering on the write side.
+            self.outbuf = bytearray()
         else:
             raise CStoreException("unknown open mode '{0}'".format(mode))
 
@@ -168,8 +246,8 @@ class CStoreBase:
             if self.mode == 'w':
                 if self.debug >= 1:
                     print("DBG: flushing output")
-                self.soxpipe.flush()
-                self.soxproc.stdin.flush()
+                self._write_out(self.outbuf)
+                self.outbuf = None
                 self.soxproc.stdin.close()
             else:
                 self.soxproc.kill()
@@ -181,209 +259,340 @@ class CStoreBase:
     # Generator emitting a sign-bit-change (sbc) stream. Every time the
     # audio signal's amplitude flips from positive to negative or vice versa,
     # emit a 1. Otherwise emit a 0. This lets higher functions determine
-    # the current frequency.
+    # the current frequency. The stream is produced in chunks, one bytes
+    # object of 0/1 values per block read from the sound input.
     def _read_sbc_generator(self):
         last_sign = 0
 
         while True:
-            # Read the next chunk of binary frames from the sound input
-            # and turn it into a bytearray.
-            frames = self.soxpipe.read(8192)
+            # Read the next chunk of binary frames from the sound input.
+            # This reads directly from the pipe's file descriptor and
+            # takes whatever is available, up to CSTORE_SOX_READSIZE.
+            frames = os.read(self.soxfd, CSTORE_SOX_READSIZE)
             if not frames:
                 break
-            sbytes = bytearray(frames)
 
-            # Produce a 1 for every time the sign of the frame changes,
-            # and a 0 otherwise.
-            for byte in sbytes:
-                sign = byte & 0x80
-                yield 1 if (sign != last_sign) else 0
-                last_sign = sign
+            # Reduce every frame to its sign (0 or 1) and XOR that with
+            # the sign of the previous frame. Doing this on the whole
+            # chunk as one big integer keeps the per frame work in C.
+            signs = frames.translate(_SBC_SIGN_TABLE)
+            prev = bytes((last_sign,)) + signs[:-1]
+            sbc = int.from_bytes(signs, 'big') ^ int.from_bytes(prev, 'big')
+            last_sign = signs[-1]
+            yield sbc.to_bytes(len(signs), 'big')
 
     # Generator emitting a '#' for a ZERO frequency halfwave and a '.' for
-    # a ONE frequency halfwave. The _read_bit_generator() is using this to
-    # output a bit stream.
+    # a ONE frequency halfwave. The _read_byte_generator() is decoding
+    # the bits from this. The halfwaves are produced as one string per
+    # sbc chunk.
     def _read_hw_generator(self):
-        # Measure the number of frames from 1 to the next 1.
-        n = 0
-        for s in self.sbc:
-            n += 1
-            if s != 0 and n > 2:
-                # If the number of frames is below the threshold this is
-                # a ZERO halfwave, otherwise a ONE halfwave.
-                yield '.' if n <= self.hwmidpoint else '#'
-                n = 0
-
-    def _read_startbit_generator(self):
-        # Calculate how many halfwaves to skip once we found
-        # a full wave of the ZERO frequency
-        skip = self.hwlen_0 - 2
-
-        # Fill the sample buffer with enought samples for each pattern.
-        # The startbit generator is called before the bit generator,
-        # so this is where it needs to happen.
-        self.hwbuffer.extend(islice(self.hw, self.hwlen_1))
-
-        # Process halfwave patterns.
+        # A halfwave is the number of frames from one sign change to the
+        # next, where a sign change within 2 frames of the previous one
+        # is ignored. In the sbc stream every halfwave is therefore two
+        # arbitrary frames, followed by zeros and a 1. Splitting the sbc
+        # stream with the regular expression below returns a 1 for every
+        # halfwave up to the hwmidpoint ('.') and a 0 for every longer
+        # one ('#'), plus empty strings and None that we filter out. This
+        # classifies a whole chunk without a Python loop.
+        hwpattern = re.compile(rb'(?s)..\x00{0,%d}(\x01)|..(\x00)\x00*\x01'
+                               % (self.hwmidpoint - 3))
+        maxcarry = self.hwmidpoint + 2
+
+        carry = b''
+        for chunk in self.sbc:
+            # Every match of the pattern is a complete halfwave, because
+            # a halfwave ends with the first 1 after its two arbitrary
+            # frames. Whatever follows the last match is the incomplete
+            # halfwave that is carried over to the next chunk. At the end
+            # of input that incomplete halfwave is ignored.
+            parts = hwpattern.split(carry + chunk)
+            carry = parts.pop()
+            hw = b''.join(filter(None, parts))
+            if hw:
+                yield hw.translate(_HW_CHAR_TABLE).decode()
+
+            # The carry is two arbitrary frames followed by zeros. During
+            # silence it would grow forever. Once it is longer than the
+            # hwmidpoint the exact length makes no difference any more.
+            if len(carry) > maxcarry:
+                carry = carry[:maxcarry]
+
+    # Make sure the halfwave window at hwpos is filled. Returns False
+    # if the input ended before that.
+    def _hw_fill(self):
+        while len(self.hwbuffer) - self.hwpos < self.hwlen_1:
+            hw = next(self.hw, None)
+            if hw is None:
+                return False
+            # Drop the halfwaves we have moved past while appending
+            self.hwbuffer = self.hwbuffer[self.hwpos:] + hw
+            self.hwpos = 0
+        return True
+
+    # Return the current halfwave window as a string for debug output
+    def _hw_window(self):
+        return self.hwbuffer[self.hwpos:self.hwpos + self.hwlen_1]
+
+    # Generate a stream of decoded bytes. This is a single state machine
+    # working on the halfwave buffer. Following the bitpattern it scans
+    # for the startbit and then decodes the data and parity bits.
+    def _read_byte_generator(self):
+        hwlen_0 = self.hwlen_0
+        hwlen_1 = self.hwlen_1
+        mid_0 = hwlen_0 >> 1
+        mid_1 = hwlen_1 >> 1
+        bitops = self.bitops
+        debug = self.debug
+
+        # Idle time before a startbit that is worth reporting in debug
+        # output, in halfwaves.
+        longlead = int(5 * hwlen_1 * 2.5)
+
         while True:
-            # Wait for at least a single ONE frequency full wave. That is
-            # two consecutive '.'.
-            if self.hwbuffer[0] != '.' or self.hwbuffer[1] != '.':
-                if self.debug >= 4:
-                    print("DBG: advance from", ''.join(self.hwbuffer))
-                self.hwbuffer.append(next(self.hw))
-                continue
-
-            # Now wait for at least two ZERO waves and consume the remaining
-            # halfwaves for that.
-            # While at it count the number of idle ONE halfwaves we
-            # are skipping over for debug purposes.
-            lead = 2
-            for hw in self.hw:
-                lead += 1
-                self.hwbuffer.append(hw)
-                if self.debug >= 4:
-                    print("DBG: scanning for ZERO in", ''.join(self.hwbuffer))
-                if (self.hwbuffer[0] == '#' and self.hwbuffer[1] == '#' and
-                    self.hwbuffer[2] == '#' and self.hwbuffer[3] == '#'):
-                    if self.debug >= 3:
+            # The input may end cleanly before a byte's first startbit.
+            # Anywhere after that the byte is incomplete.
+            byteval = 0
+            inbyte = False
+            for op, mask in bitops:
+                if op == CSTORE_BIT_START:
+                    # Scan for the startbit. Only positions that have a full
+                    # window of hwlen_1 halfwaves behind them are looked at.
+                    while True:
+                        if (len(self.hwbuffer) - self.hwpos < hwlen_1
+                                and not self._hw_fill()):
+                            if inbyte:
+                                raise CStoreException("unexpected end of "
+                                                      + "input")
+                            return
+
+                        # Wait for at least a single ONE frequency full
+                        # wave. That is two consecutive '.'.
+                        buf = self.hwbuffer
+                        pos = self.hwpos
+                        last = len(buf) - hwlen_1
+                        found = buf.find('..', pos, last + 2)
+                        end = found if found >= 0 else last + 1
+                        if debug >= 4:
+                            for p in range(pos, end):
+                                print("DBG: advance from", buf[p:p + hwlen_1])
+                        self.hwpos = end
+                        if found >= 0:
+                            break
+
+                    # Now wait for at least two ZERO waves and consume the
+                    # remaining halfwaves for that.
+                    # While at it count the number of idle ONE halfwaves we
+                    # are skipping over for debug purposes.
+                    lead = 2
+                    self.hwpos += 1
+                    while True:
+                        if (len(self.hwbuffer) - self.hwpos < hwlen_1
+                                and not self._hw_fill()):
+                            if inbyte:
+                                raise CStoreException("unexpected end of "
+                                                      + "input")
+                            return
+                        buf = self.hwbuffer
+                        pos = self.hwpos
+                        last = len(buf) - hwlen_1
+                        found = buf.find('####', pos, last + 4)
+                        end = found + 1 if found >= 0 else last + 1
+                        if debug >= 4:
+                            for p in range(pos, end):
+                                print("DBG: scanning for ZERO in",
+                                      buf[p:p + hwlen_1])
+                        lead += end - pos
+                        if found >= 0:
+                            break
+                        self.hwpos = end
+
+                    self.hwpos = found
+                    if debug >= 3:
                         # Report lead/idle time
-                        if lead > int(5 * self.hwlen_1 * 2.5):
+                        if lead > longlead:
                             ms = lead / self.basefreq / 2.0 * 1000.0
                             print("DBG: lead of {0:.2f}ms".format(ms))
-                        print("DBG: START from", ''.join(self.hwbuffer))
-                    self.hwbuffer.extend(islice(self.hw, self.hwlen_0))
-
-                    # Return the ZERO startbit and wait for the
-                    # next call.
-                    yield 0
-                    break
-
-    # Generate a stream of decoded bits. This is only called from
-    # higher generators after a startbit has been detected and we
-    # are synchronized on a bit-boundary. So we can simply scan
-    # a sufficient number of frames and look at the frequency detected
-    # in the middle of them.
-    def _read_bit_generator(self):
-        while True:
-            if self.hwbuffer[int(self.hwlen_0 / 2)] == '#':
-                if self.debug >= 3:
-                    print("DBG: ZERO  from", ''.join(self.hwbuffer))
-                self.hwbuffer.extend(islice(self.hw, self.hwlen_0))
-                yield 0
-            elif self.hwbuffer[int(self.hwlen_1 / 2)] == '.':
-                if self.debug >= 3:
-                    print("DBG: ONE   from", ''.join(self.hwbuffer))
-                self.hwbuffer.extend(islice(self.hw, self.hwlen_1))
-                yield 1
-            else:
-                raise CStoreException("could not determine bit from " +
-                                      "".join(map(str, self.hwbuffer)))
-
-
-    # Generate a stream of decoded bytes.
-    def _read_byte_generator(self):
-        try:
-            while True:
-                byteval = 0
-                num_one = 0
-                for state in self.bitpattern:
-                    if state in ['0', '1', '2', '3', '4', '5', '6', '7']:
-                        if next(self.bits):
-                            byteval |= (1 << int(state))
-                            num_one += 1
-                    elif state == 'S':
-                        next(self.startbit)
-                    elif state == 'E':
-                        b = next(self.bits)
-                        if (num_one % 2) != b:
-                            raise CStoreException("parity error")
-                    elif state == 'O':
-                        b = next(self.bits)
-                        if (num_one % 2) == b:
-                            raise CStoreException("parity error")
-                    elif state == '-':
-                        pass
-
-                # Generate the byte we just decoded.
-                if self.debug >= 2:
-                    char = chr(byteval)
-                    if not char.isprintable() or char in ['\n','\r','\b']:
-                        char = '.'
-                    print("DBG: {0:02x} '{1}'".format(byteval, char))
-                yield byteval
-        except StopIteration:
-            pass
+                        print("DBG: START from", self._hw_window())
+                    self.hwpos += hwlen_0
+                    inbyte = True
+                    continue
+
+                if op == CSTORE_BIT_STOP:
+                    # The stopbits are idle ONE signal that the next
+                    # startbit scan skips over.
+                    continue
+
+                # We are synchronized on a bit-boundary. So we can simply
+                # look at the frequency detected in the middle of the
+                # bit window.
+                if (len(self.hwbuffer) - self.hwpos < hwlen_1
+                        and not self._hw_fill()):
+                    raise CStoreException("unexpected end of input")
+                pos = self.hwpos
+                if self.hwbuffer[pos + mid_0] == '#':
+                    if debug >= 3:
+                        print("DBG: ZERO  from", self._hw_window())
+                    self.hwpos = pos + hwlen_0
+                    bit = 0
+                elif self.hwbuffer[pos + mid_1] == '.':
+                    if debug >= 3:
+                        print("DBG: ONE   from", self._hw_window())
+                    self.hwpos = pos + hwlen_1
+                    bit = 1
+                else:
+                    raise CStoreException("could not determine bit from " +
+                                          self._hw_window())
+
+                # The databits collect in byteval. The parity is taken
+                # from the one-bits it has so far.
+                if op == CSTORE_BIT_DATA:
+                    if bit:
+                        byteval |= mask
+                elif op == CSTORE_BIT_EVEN:
+                    if (bin(byteval).count('1') & 1) != bit:
+                        raise CStoreException("parity error")
+                elif op == CSTORE_BIT_ODD:
+                    if (bin(byteval).count('1') & 1) == bit:
+                        raise CStoreException("parity error")
+
+            # Generate the byte we just decoded.
+            if debug >= 2:
+                sys.stdout.write("DBG: {0:02x} '{1}'\n".format(
+                                 byteval, CSTORE_DBG_BYTE_CHARS[byteval]))
+            yield byteval
 
     def _wait_for_leadin(self, basefreq, duration = 0.5):
-        # We create a sample buffer the size of number of audio frames
-        # for the requested duration of the carrier signal.
+        # We collect sbc chunks in a sample buffer and look at a window
+        # the size of number of audio frames for the requested duration
+        # of the carrier signal.
         sample_size = int(CSTORE_SOX_RATE * duration)
-        sample = deque(maxlen = sample_size)
-        sample.extend(islice(self.sbc, sample_size - 1))
-
-        # We then scan for a steady signal of the one-bit frequency.
-        # Doesn't have to be 100% accurate
-        for val in self.sbc:
-            sample.append(val)
-            if abs(sum(sample) - int(basefreq * duration * 2)) < basefreq / 25:
-                # We found the carrier wave. Advance 0.2 seconds further to
-                # eliminate any early junk, then measure the actual basefreq.
-                sample.extend(islice(self.sbc, int(CSTORE_SOX_RATE / 5 - 1)))
-                self.basefreq = int(sum(sample) / duration / 2)
-                if self.debug >= 1:
-                    print("DBG: detected basefreq =", self.basefreq)
-                return True
-
-            # If not found yet we just move ahead by 100ms so we don't
-            # have to do the above for every single audio frame.
-            sample.extend(islice(self.sbc, int(CSTORE_SOX_RATE / 10 - 1)))
+        sample = bytearray()
+        end = sample_size
+
+        # The expected number of sign changes in the window for a steady
+        # carrier, the tolerance for that and the step size by which the
+        # window moves ahead.
+        expected = int(basefreq * duration * 2)
+        tolerance = basefreq / 25
+        step = int(CSTORE_SOX_RATE / 10)
+
+        # The number of sign changes in the window is maintained as a
+        # running count. When the window moves ahead we only count what
+        # entered and what left it instead of the whole window again.
+        # The count covers the window ending at "counted".
+        count = 0
+        counted = 0
+
+        for chunk in self.sbc:
+            sample.extend(chunk)
+            while end <= len(sample):
+                # We then scan for a steady signal of the one-bit frequency.
+                # Doesn't have to be 100% accurate
+                start = end - sample_size
+                count += (sample.count(1, counted, end)
+                          - sample.count(1, max(counted - sample_size, 0),
+                                         start))
+                counted = end
+                if abs(count - expected) < tolerance:
+                    # We found the carrier wave. Advance 0.2 seconds further
+                    # to eliminate any early junk, then measure the actual
+                    # basefreq.
+                    end += int(CSTORE_SOX_RATE / 5 - 1)
+                    while len(sample) < end:
+                        more = next(self.sbc, None)
+                        if more is None:
+                            break
+                        sample.extend(more)
+                    start = min(end, len(sample)) - sample_size
+                    self.basefreq = int(sample.count(1, start, end)
+                                        / duration / 2)
+                    if self.debug >= 1:
+                        print("DBG: detected basefreq =", self.basefreq)
+
+                    # Put whatever we read beyond the window back in front
+                    # of the sbc stream.
+                    self.sbc = chain([bytes(sample[end:])], self.sbc)
+                    return True
+
+                # If not found yet we just move ahead by 100ms so we don't
+                # have to do the above for every single audio frame.
+                end += step
+
+            # Discard what has scrolled out of the counted window
+            drop = max(counted - sample_size, 0)
+            del sample[:drop]
+            counted -= drop
+            end -= drop
 
         raise CStoreException("no carrier signal detected")
 
     # Write raw frame data to the output (sound-card or sound-file)
     def _write_frames(self, frames):
-        self.soxpipe.write(frames)
+        self.outbuf += frames
+        if len(self.outbuf) >= CSTORE_OUTPUT_FLUSH:
+            self._write_out(self.outbuf)
+            self.outbuf.clear()
+
+    # Write a buffer to the sox(1) pipe. A pipe may accept only part of
+    # a large write, so keep going until all of it is out.
+    def _write_out(self, buf):
+        written = os.write(self.soxfd, buf)
+        while written < len(buf):
+            written += os.write(self.soxfd, buf[written:])
 
     # Write one-bits for the requested duration in seconds. This is a lead-in.
     def _write_ones(self, duration):
         numwaves = int(CSTORE_SOX_RATE / len(self.frames1) * duration)
-        self._write_frames(bytes(self.frames1 * numwaves))
-
-    # Encode data bytes as configured
-    def _write_byte(self, b):
-        frames = deque()
-
-        if self.debug >= 2:
-            print("DBG: writing byte {0:02x}".format(b))
-        # Build the whole frame sequence and count one-bits
+        self._write_frames(self.frames1 * numwaves)
+
+    # Build the audio frames for a data byte as configured. Zero and one
+    # bits have the same duration, so each bit is copied into its slot
+    # of a buffer of the final size.
+    def _encode_byte(self, b):
+        frames0 = self.frames0
+        frames1 = self.frames1
+        bitlen = len(frames0)
+        frames = bytearray(bitlen * len(self.bitops))
+        pos = 0
         num_ones = 0
-        for state in self.bitpattern:
-            if state in ['0', '1', '2', '3', '4', '5', '6', '7']:
+        for op, mask in self.bitops:
+            if op == CSTORE_BIT_DATA:
                 # Emit the databit
-                if b & (1 << int(state)):
-                    frames.extend(self.frames1)
+                if b & mask:
+                    frames[pos:pos + bitlen] = frames1
                     num_ones += 1
                 else:
-                    frames.extend(self.frames0)
-            elif state == 'S':
+                    frames[pos:pos + bitlen] = frames0
+            elif op == CSTORE_BIT_START:
                 # Emit a sartbit
-                frames.extend(self.frames0)
-            elif state == 'E':
+                frames[pos:pos + bitlen] = frames0
+            elif op == CSTORE_BIT_EVEN:
                 # Emit an EVEN paritybit
                 if (num_ones % 2) == 0:
-                    frames.extend(self.frames0)
+                    frames[pos:pos + bitlen] = frames0
                 else:
-                    frames.extend(self.frames1)
-            elif state == 'O':
+                    frames[pos:pos + bitlen] = frames1
+            elif op == CSTORE_BIT_ODD:
                 # Emit an ODD paritybit
                 if (num_ones % 2) == 0:
-                    frames.extend(self.frames1)
+                    frames[pos:pos + bitlen] = frames1
                 else:
-                    frames.extend(self.frames0)
-            elif state == '-':
+                    frames[pos:pos + bitlen] = frames0
+            elif op == CSTORE_BIT_STOP:
                 # Emit a stopbit
-                frames.extend(self.frames1)
+                frames[pos:pos + bitlen] = frames1
+            pos += bitlen
+        return bytes(frames)
 
-        # Push the audio frames to the output
-        self._write_frames(bytes(frames))
+    # Encode a data byte as configured
+    def _write_byte(self, b):
+        if self.debug >= 2:
+            print("DBG: writing byte {0:02x}".format(b))
+        self._write_frames(self.byteframes[b])
+
+    # Encode a sequence of data bytes as configured
+    def _write_bytes(self, data):
+        if self.debug >= 2:
+            for b in data:
+                print("DBG: writing byte {0:02x}".format(b))
+        self._write_frames(b''.join(map(self.byteframes.__getitem__, data)))
@@ -3,11 +3,16 @@
 # ----
 
 from collections import deque
-from itertools import islice
 import re
 
 from cassette_store.cstore_base import *
 
+# Patterns for the text format: the data header, a memory register line
+# and the %1.9e formatted number split up by _float2bytes().
+_RE_HEADER = re.compile(r'^(F[P ])(\d\d\d)$')
+_RE_REGISTER = re.compile(r'^([^:]*):\s*(.*)')
+_RE_FLOAT = re.compile(r'(-?)(\d)\.(\d*)e([-\+])(\d*)')
+
 # ----
 # CStoreCasioFX502P
 #
@@ -22,10 +27,6 @@ from cassette_store.cstore_base import *
 class CStoreCasioFX502P(CStoreBase):
     def __init__(self, fname = None, mode = 'r', gain = None, sinc = None,
                  debug = False):
-        # Build the text->byte token table by reversing the byte->text one
-        self.TOKENS_T2B = {self.TOKENS_B2T[b].upper(): b
-                           for b in self.TOKENS_B2T}
-
         # Open the requested input and configure the protocol.
         super().__init__(fname, 
                          mode       = mode,
@@ -46,29 +47,31 @@ class CStoreCasioFX502P(CStoreBase):
             if b == 0xff:
                 break
             yield b
+        else:
+            # The input ended before the EOF marker
+            raise CStoreException("unexpected end of input")
 
     def write(self, data):
         # Write the lead-in
         self._write_ones(4.0)
 
-        # Write the program/memory data itself
-        for b in bytes(data):
-            self._write_byte(b)
-
-        # Write 128 times EOF
-        for i in range(128):
-            self._write_byte(0xff)
+        # Write the program/memory data itself, followed by 128 times EOF,
+        # as one block of audio frames.
+        self._write_bytes(bytes(data) + b'\xff' * 128)
         
     def bytes2text(self, data):
         # Convert the first two bytes into the BCD encoded header bytes.
         start = "{0:02X}{1:02X}".format(data[1], data[0])
 
+        # The text is collected as a list of pieces and joined at the end.
         if start[0] == 'B':
             # The header indicates a program. Emit the proper 'FPnnn' header.
-            output = "FP" + start[1:]
+            output = ["FP" + start[1:]]
 
-            # Decode the remaining bytes as programe text.
+            # Decode the remaining bytes as programe text. We keep track
+            # of the length the joined line will have.
             line = []
+            linelen = -1
             for byte in data[2:]:
                 # If there is a token for this byte value, use it.
                 # Otherwise convert it into a hex number (There are
@@ -82,62 +85,78 @@ class CStoreCasioFX502P(CStoreBase):
                 # If the token ends in ':' we do a bit of special formatting
                 if token[-1] == ':':
                     if len(line) > 0:
-                        output += '\n    ' + ' '.join(line)
+                        output.append('\n    ' + ' '.join(line))
                         line = []
-                    output += '\n'
+                        linelen = -1
+                    output.append('\n')
                     if token[0] == 'P':
-                        output += '' + token
+                        output.append(token)
                     else:
-                        output += '  ' + token
+                        output.append('  ' + token)
                 else:
                     line.append(token)
+                    linelen += len(token) + 1
 
                 # Break up lines so they don't exceed 80 characters
-                if len(' '.join(line)) >= 70:
-                    output += '\n    ' + ' '.join(line)
+                if linelen >= 70:
+                    output.append('\n    ' + ' '.join(line))
                     line = []
+                    linelen = -1
 
             # Emit anything left in the decoded line.
             if len(line) > 0:
-                output += '\n    ' + ' '.join(line)
+                output.append('\n    ' + ' '.join(line))
 
         elif start[0] == 'F':
             # The header indicates memory data. Emit the 'F nnn' header.
-            output = "F " + start[1:] + '\n'
-            data = data[2:]
+            output = ["F " + start[1:] + '\n']
 
-            # Decode and add all non-zero registers to the output.
+            # Decode and add all non-zero registers to the output. The
+            # registers are 8 bytes each, following the header.
+            view = memoryview(data)
+            pos = 2
             for mem in self.MEMORY_SEQ:
-                num = islice(data, 8)
-                data = data[8:]
-                outnum = self._bytes2number(num)
+                outnum = self._bytes2number(iter(view[pos:pos + 8]))
+                pos += 8
                 if outnum != '0.0':
-                    output = output + mem + ': ' + outnum + '\n'
+                    output.append(mem + ': ' + outnum + '\n')
         else:
             # Didn't recognize what this byte stream means.
             raise CStoreException(
                     "unrecognized FX502P data header '{0}'".format(start))
             
-        return output + '\n'
-
-    def _bcd2digits(self, bcd):
-        return "{0:02X}".format(bcd)
+        return ''.join(output) + '\n'
+
+    def _bcd2int(self, bcd):
+        # Convert a BCD encoded byte into its value 0..99
+        hi = bcd >> 4
+        lo = bcd & 0x0f
+        if hi > 9 or lo > 9:
+            raise CStoreException("invalid BCD byte 0x{0:02X}".format(bcd))
+        return hi * 10 + lo
+
+    def _int2bcd(self, val):
+        # Convert a value 0..99 into a BCD encoded byte
+        if val < 0 or val > 99:
+            raise CStoreException("value {0} out of BCD range".format(val))
+        return ((val // 10) << 4) | (val % 10)
 
     def _bytes2number(self, data):
         # Convert an FX502P number into something readable
         # We first consume the BCD encoded exponent and the binary flags
-        exponent = int(self._bcd2digits(next(data)))
+        exponent = self._bcd2int(next(data))
         flags = next(data)
 
         # Next we consume the 6 BCD encoded bytes. Those make up 10 decimal
         # digits in reverse byte order and the first and last nibble ignored.
-        # Yes, that is a rather strange storage format. We convert that into
-        # float value representing the mantissa.
-        digits = ""
-        for byte in data:
-            digits = self._bcd2digits(byte) + digits
-        digits = (digits[1] + '.' + digits[2:])
-        val = float(digits)
+        # Yes, that is a rather strange storage format. We accumulate the
+        # digits as an integer, starting with the low nibble of the last
+        # byte, and scale that to the float value representing the mantissa.
+        mantissa = list(data)
+        digits = self._bcd2int(mantissa[5] & 0x0f)
+        for byte in mantissa[4::-1]:
+            digits = digits * 100 + self._bcd2int(byte)
+        val = digits / 10000000000
 
         # Apply the negative flag
         if flags & 0x08:
@@ -160,7 +179,7 @@ class CStoreCasioFX502P(CStoreBase):
 
     def text2bytes(self, txt):
         data = deque()
-        es = ""
+        es = []
         e = 0
         l = 0
 
@@ -171,7 +190,7 @@ class CStoreCasioFX502P(CStoreBase):
         # 'FPnnn' for program data and 'F nnn' for memory
         # data where 'nnn' is the 3-digits entered at SAVE.
         header = next(lines)
-        m = re.match('^(F[P ])(\d\d\d)$', header)
+        m = _RE_HEADER.match(header)
         if m is None:
             raise CStoreException("no FX502P header in '{0}'".format(header))
 
@@ -189,7 +208,8 @@ class CStoreCasioFX502P(CStoreBase):
                     if tok == 'INV':
                         continue
                     if tok not in self.TOKENS_T2B:
-                        es += "line {0}: unrecognized token '{1}'\n".format(l, tok)
+                        es.append("line {0}: unrecognized token '{1}'\n"
+                                  .format(l, tok))
                         e += 1
                     else:
                         data.append(self.TOKENS_T2B[tok])
@@ -204,9 +224,10 @@ class CStoreCasioFX502P(CStoreBase):
 
             for line in lines:
                 # Process all the lines and change the register values
-                m = re.match('^([^:]*):\s*(.*)', line)
+                m = _RE_REGISTER.match(line)
                 if m is None:
-                    es += "line {0}: invalid format '{1}'\n".format(l, line)
+                    es.append("line {0}: invalid format '{1}'\n"
+                              .format(l, line))
                     e += 1
                     continue
 
@@ -215,13 +236,14 @@ class CStoreCasioFX502P(CStoreBase):
                 try:
                     val = float(m.group(2))
                 except Exception as ex:
-                    ex += "line {0}:" + str(ex) + '\n'
+                    es.append("line {0}: {1}\n".format(l, ex))
                     e += 1
                     continue
 
                 # Check that we know this register name
                 if reg not in registers:
-                    es += "line {0}: unknown register '{1}'\n".format(l, reg)
+                    es.append("line {0}: unknown register '{1}'\n"
+                              .format(l, reg))
                     e += 1
                     continue
 
@@ -236,7 +258,8 @@ class CStoreCasioFX502P(CStoreBase):
             raise CStoreException("no FX502P header in '{0}'".format(header))
 
         if e > 0:
-            raise CStoreException(es + "{0} error(s) parsing program text".format(e))
+            raise CStoreException(''.join(es) +
+                    "{0} error(s) parsing program text".format(e))
         
         return bytes(data)
         
@@ -249,26 +272,31 @@ class CStoreCasioFX502P(CStoreBase):
 
         # Convert the value into %1.9e format and split it via regexp
         strval = "{0:1.9e}".format(val)
-        m = re.match('(-?)(\d)\.(\d*)e([-\+])(\d*)', strval)
+        m = _RE_FLOAT.match(strval)
 
         # Set flag if mantissa is negative
         if m.group(1) == '-':
             flags |= 0x08
 
         # Set flag and add exponent depending on sign of exponent
+        if int(m.group(5)) > (99 if m.group(4) == '+' else 100):
+            raise CStoreException(
+                    "number {0} out of FX502P range".format(val))
         if m.group(4) == '+':
             flags |= 0x01
-            result.append(int("{0:02d}".format(int(m.group(5))), 16))
+            result.append(self._int2bcd(int(m.group(5))))
         else:
-            result.append(int("{0:02d}".format(100 - int(m.group(5))), 16))
+            result.append(self._int2bcd(100 - int(m.group(5))))
         
         # Add the flag byte
         result.append(flags)
 
-        # Add the mantissa digits
-        digits = '0' + m.group(2) + m.group(3) + '0'
-        for i in [10, 8, 6, 4, 2, 0]:
-            result.append(int(digits[i:i + 2], 16))
+        # Add the mantissa digits. The 10 digits get a 0 nibble added on
+        # both ends and are stored as 6 BCD bytes, lowest pair first.
+        digits = int(m.group(2) + m.group(3)) * 10
+        for i in range(6):
+            result.append(self._int2bcd(digits % 100))
+            digits //= 100
 
         return result
 
@@ -554,4 +582,7 @@ class CStoreCasioFX502P(CStoreBase):
         0xff:   'EOF',
     }
 
+    # The text->byte token table is the reverse of the byte->text one
+    TOKENS_T2B = {v.upper(): k for k, v in TOKENS_B2T.items()}
+
 
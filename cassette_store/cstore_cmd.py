@@ -4,13 +4,16 @@
 #
 # Command line entry points for cassette_store.
 # ----
+import os
 import sys
 import argparse
-from collections import deque
+import tempfile
 from itertools import islice
 
 from cassette_store import *
 
+CSTORE_SAVE_CHUNKSIZE = 4096
+
 # ----
 # Entry point for cstore(1)
 # ----
@@ -75,29 +78,63 @@ def _cstore_save(handler, args):
     # Open the input (file or sound-card)
     with handler(args.input, 'r', gain = args.gain, sinc = args.sinc,
                  debug = args.debug) as cstore:
-        # Get the raw data as a bytearray, stop at the first EOF (0xff)
-        data = deque()
-        data.extend(cstore.bytes)
-        data = bytearray(data)
-
-        if args.output is None:
-            if args.binary:
+        if args.binary:
+            # Binary data is streamed to the output in chunks as the
+            # protocol handler's bytes generator produces it. The
+            # generator stops at the end of the data.
+            if args.output is None:
                 # Binary data requested on stdout
-                sys.stdout.buffer.write(data)
+                _write_chunks(sys.stdout.buffer, cstore.bytes)
             else:
-                # Text data (mnemonics) requested on stdout
-                prog = cstore.bytes2text(data)
-                print(prog, end = '')
+                # Binary data requested as OUTPUT file. It is streamed
+                # into a temporary file next to it, which replaces
+                # OUTPUT only after all data was decoded. A failed save
+                # leaves no partial OUTPUT behind.
+                fd, tmpname = tempfile.mkstemp(
+                        dir = os.path.dirname(args.output) or '.')
+                try:
+                    with os.fdopen(fd, 'wb') as fp:
+                        _write_chunks(fp, cstore.bytes)
+                    # mkstemp() creates the file private to the user,
+                    # give it the permissions open() would have.
+                    os.chmod(tmpname, 0o666 & ~_get_umask())
+                    os.replace(tmpname, args.output)
+                except BaseException:
+                    os.remove(tmpname)
+                    raise
         else:
-            if args.binary:
-                # Binary data requested as OUTPUT file
-                with open(args.output, 'wb') as fd:
-                    fd.write(data)
+            # Get the raw data as a bytearray and convert it to text
+            # (mnemonics).
+            prog = cstore.bytes2text(bytearray(cstore.bytes))
+
+            if args.output is None:
+                # Text data requested on stdout
+                print(prog, end = '')
             else:
-                # Text data (mnemonics) requested as OUTPUT file
-                prog = cstore.bytes2text(data)
+                # Text data requested as OUTPUT file
                 with open(args.output, 'w') as fd:
                     fd.write(prog)
+
+# ----
+# _get_umask()
+#
+#   Return the current umask. It can only be read by setting it.
+# ----
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# ----
+# _write_chunks()
+#
+#   Write the bytes produced by a generator to a binary file in
+#   batches of CSTORE_SAVE_CHUNKSIZE bytes.
+# ----
+def _write_chunks(fd, gen):
+    for chunk in iter(lambda: bytes(islice(gen, CSTORE_SAVE_CHUNKSIZE)), b''):
+        fd.write(chunk)
+
 # ----
 # load action - cstore is reading input and calculator is recieving the audio
 # ----
@@ -124,6 +161,6 @@ def _cstore_load(handler, args):
                     prog = fd.read()
                     data = cstore.text2bytes(prog)
 
-        # Send the data to the calculator as audio
+        # Send the data to the calculator as audio. Leaving the with
+        # block closes the output.
         cstore.write(data)
-        cstore.close()
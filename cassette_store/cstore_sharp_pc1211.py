@@ -2,7 +2,6 @@
 # cstore_sharp_pc1211
 # ----
 
-from collections import deque
 from itertools import islice
 import re
 
@@ -10,6 +9,42 @@ from cassette_store.cstore_base import *
 
 CSTORE_PC1211_PROG  = 0x80
 
+# Swap the upper and lower nibble of every byte in data. The PC1211
+# stores the filename like that. All bytes are done at once as one
+# big integer.
+def pc1211_swap_nibbles(data):
+    n = len(data)
+    val = int.from_bytes(data, 'big')
+    mask = int.from_bytes(b'\x0f' * n, 'big')
+    return (((val & mask) << 4) | ((val >> 4) & mask)).to_bytes(n, 'big')
+
+# Patterns for the program text format: the header, a numbered program
+# line and a single token within it. A token is a run of letters that
+# may be a keyword, a double quoted string, a hex byte, a special two
+# character symbol or any other single character. Keywords, strings and
+# single characters swallow the whitespace following them.
+_RE_HEADER = re.compile(r'^PROGRAM\s*"([^"]+)"$')
+_RE_LINE = re.compile(r'(\d+):(.*)')
+_RE_TOKEN = re.compile(r'([A-Z][A-Z]+)\s*'
+                       r'|("[^"]*")\s*'
+                       r'|(\[[0-9a-fA-F]+\])'
+                       r'|(\|E|>=|<=|<>)'
+                       r'|(\S)\s*')
+_TOK_KEYWORD = 1
+_TOK_STRING = 2
+_TOK_HEX = 3
+
+# Add a byte to a PC1211 checksum. The upper nibble is added with an ADD
+# and the lower nibble with ADDC to a virtual 8-bit accumulator, so the
+# carry of the first addition goes into the second.
+def _pc1211_chksum_add(chksum, b):
+    chksum += b >> 4
+    return (chksum + (chksum >> 8) + (b & 0x0f)) & 0xff
+
+# The decimal value of every two digit BCD byte. Line numbers are
+# stored as 0xEnnn, this covers the lower two digits.
+_PC1211_BCD_TABLE = tuple((b >> 4) * 10 + (b & 0x0f) for b in range(256))
+
 # ----
 # CStoreSharpPC1211
 #
@@ -18,12 +53,6 @@ CSTORE_PC1211_PROG  = 0x80
 class CStoreSharpPC1211(CStoreBase):
     def __init__(self, fname = None, mode = 'r', gain = None, sinc = None,
                  debug = False):
-        # Build the text->byte token table by reversing the byte->text one
-        self.TOKENS_T2B = {self.TOKENS_B2T[b].upper(): b
-                           for b in self.TOKENS_B2T}
-        # Add convenience tokens for text input
-        self.TOKENS_T2B['SQRT '] = 0x1a
-
         # Open the requested input and configure the protocol.
         super().__init__(fname, 
                          mode       = mode,
@@ -41,7 +70,9 @@ class CStoreSharpPC1211(CStoreBase):
 
     def _read_bytes_until_eof(self):
         # First byte must be the file type ident byte
-        b = next(self.allbytes)
+        b = next(self.allbytes, None)
+        if b is None:
+            raise CStoreException("unexpected end of input")
         if b == CSTORE_PC1211_PROG:
             ident = b
         else:
@@ -50,6 +81,7 @@ class CStoreSharpPC1211(CStoreBase):
         yield b
 
         have_filename = False
+        debug = self.debug
 
         chksum = 0
         chkcount = 0
@@ -62,7 +94,7 @@ class CStoreSharpPC1211(CStoreBase):
                 # nibble with ADDC to a virtual 8-bit accumulator.
                 if (chkcount % 9) == 0:
                     # This is a checksum byte. Check it.
-                    if self.debug >= 2:
+                    if debug >= 2:
                         print("DBG: {0:02x} {1:02x} ".format(b, chksum)
                               + "checksum")
                     if b != chksum:
@@ -79,22 +111,20 @@ class CStoreSharpPC1211(CStoreBase):
                             chkcount = 0
                 else:
                     # Regular data byte processing. Add up checksum.
-                    chksum += (b & 0xf0) >> 4
-                    if chksum > 0xff:
-                        chksum = (chksum + 1) & 0xff
-                    chksum = (chksum + (b & 0x0f)) & 0xff
+                    chksum = _pc1211_chksum_add(chksum, b)
 
-                    if self.debug >= 2:
-                        char = chr(b)
-                        if not char.isprintable() or char in ['\n', '\r', '\b']:
-                            char = '.'
-                        print("DBG: {0:02x} '{1}'".format(b, char))
+                    if debug >= 2:
+                        print("DBG: {0:02x} '{1}'".format(
+                              b, CSTORE_DBG_BYTE_CHARS[b]))
 
                     # Emit the data byte and stop after reading the
                     # EOF marker.
                     yield b
                     if b == 0xf0:
                         break
+        else:
+            # The input ended before the EOF marker
+            raise CStoreException("unexpected end of input")
 
     def write(self, data):
         self._write_reset_chksum()
@@ -110,7 +140,7 @@ class CStoreSharpPC1211(CStoreBase):
         self.chkcount = 0
         
     def _write_data(self, data):
-        bytegen = self._write_byte_generator(data)
+        bytegen = iter(data)
         for b in bytegen:
             if b == CSTORE_PC1211_PROG:
                 self.ident = CSTORE_PC1211_PROG
@@ -126,30 +156,25 @@ class CStoreSharpPC1211(CStoreBase):
             else:
                 raise CStoreException("unknown record type 0x{0:02x}".format(b))
 
-    def _write_byte_generator(self, data):
-        for b in data:
-            yield b
-
     def _write_filename(self, bytegen):
         if self.debug >= 1:
             print("DBG: writing filename")
         self._write_byte(self.ident)
         self._write_reset_chksum()
 
-        fname = deque()
-        fname.extend(islice(bytegen, 8))
-        for b in fname:
-            self._write_byte(b)
+        self._write_bytes(bytes(islice(bytegen, 8)))
         self._write_reset_chksum()
         self._write_ones(0.25)
 
     def _write_progline(self, firstbyte, bytegen):
-        self._write_byte(firstbyte)
-        self._write_byte(next(bytegen))
+        # Collect the line number and the tokens up to the terminating
+        # NUL byte and write them all at once.
+        line = bytearray((firstbyte, next(bytegen)))
         for b in bytegen:
-            self._write_byte(b)
+            line.append(b)
             if b == 0:
                 break
+        self._write_bytes(line)
 
     def _write_byte(self, byteval, is_checksum = False):
         # Use our superclass to write the actual byte audio
@@ -160,12 +185,29 @@ class CStoreSharpPC1211(CStoreBase):
             return
 
         # Handle checksum
-        self.chksum += (byteval & 0xf0) >> 4
-        if self.chksum > 0xff:
-            self.chksum += 1
-        self.chksum = (self.chksum + (byteval & 0x0f)) & 0xff
+        self.chksum = _pc1211_chksum_add(self.chksum, byteval)
         self.chkcount += 1
-
+        self._write_chksum()
+
+    def _write_bytes(self, data):
+        # Split the data into runs that end where the next checksum is
+        # due and let our superclass write each run in one go.
+        pos = 0
+        while pos < len(data):
+            run = data[pos:pos + 8 - (self.chkcount % 8)]
+            super()._write_bytes(run)
+
+            # Handle checksum
+            chksum = self.chksum
+            for b in run:
+                chksum = _pc1211_chksum_add(chksum, b)
+            self.chksum = chksum
+            self.chkcount += len(run)
+            self._write_chksum()
+
+            pos += len(run)
+
+    def _write_chksum(self):
         # Emit a checksum every 8 bytes
         if (self.chkcount % 8) == 0:
             if self.debug >= 2:
@@ -186,50 +228,46 @@ class CStoreSharpPC1211(CStoreBase):
     def _progbytes2text(self, data):
         # The first 8-byte record (after the 0x80 ident) contains the
         # filename.
-        fname = ""
-        for i in range(7, 0, -1):
-            b = ((data[i] & 0xf0) >> 4) | ((data[i] & 0x0f) << 4)
-            if b != 0x00:
-                fname += self._progbyte2token(b)
-        text = 'PROGRAM "{0}"\n'.format(fname)
-
-        # From here on we expect program code lines
-        linedata = deque()
-        linedata.extend(data[9:])
-
-        while linedata[0] != 0xf0:
+        fname = ''.join([self.TOKENS_B2T_TABLE[b] for b in
+                         pc1211_swap_nibbles(bytes(data[7:0:-1]))
+                         if b != 0x00])
+        text = ['PROGRAM "{0}"\n'.format(fname)]
+
+        # From here on we expect program code lines. We walk the data
+        # with an index and collect the text lines in a list.
+        pos = 9
+        while data[pos] != 0xf0:
             # Program lines start with the line number encode in BCD as
             # 0xEnnn
-            b1 = linedata.popleft()
-            b2 = linedata.popleft()
+            b1 = data[pos]
+            b2 = data[pos + 1]
             if (b1 & 0xf0) == 0xE0:
-                lineno = (int(b1 & 0x0f) * 100 + int((b2 & 0xf0) >> 4) * 10
-                          + int(b2 & 0x0f))
-                text += "{0:d}:".format(lineno)
+                lineno = (b1 & 0x0f) * 100 + _PC1211_BCD_TABLE[b2]
             else:
                 raise CStoreException("unknown line number format 0x"
                                       + "{0:02X}{1:02X}".format(b1, b2))
             
             # Lines end with a 0x00
-            while linedata[0] != 0x00:
-                text += self._progbyte2token(linedata.popleft())
-            text = text.rstrip() + '\n'
-            linedata.popleft()
+            end = data.find(0x00, pos + 2)
+            if end < 0:
+                raise CStoreException("line {0:d} has no end".format(lineno))
+            line = ''.join(map(self.TOKENS_B2T_TABLE.__getitem__,
+                               data[pos + 2:end]))
+            text.append("{0:d}:{1}".format(lineno, line).rstrip() + '\n')
+            pos = end + 1
         
-        return text
+        return ''.join(text)
 
     def _progbyte2token(self, byte):
-        if byte in self.TOKENS_B2T:
-            return self.TOKENS_B2T[byte]
-        else:
-            return "[{0:02X}]".format(byte)
+        return self.TOKENS_B2T_TABLE[byte]
 
     def text2bytes(self, txt):
         # Split the text into lines and determine from the first
-        # line what to do.
-        lines = txt.upper().strip().split('\n')
+        # line what to do. The PC-1211 has no lower case characters,
+        # so every line is converted to upper case as it is parsed.
+        lines = txt.strip().split('\n')
 
-        m = re.match('^PROGRAM\s*"([^"]+)"$', lines[0].strip())
+        m = _RE_HEADER.match(lines[0].strip().upper())
         if m:
             data = self._progtext2bytes(m.group(1), lines[1:])
         else:
@@ -239,7 +277,7 @@ class CStoreSharpPC1211(CStoreBase):
         return data
         
     def _progtext2bytes(self, fname, lines):
-        data = deque()
+        data = bytearray()
 
         # Start with the PC-1211 Program Ident (0x80)
         data.append(CSTORE_PC1211_PROG)
@@ -247,31 +285,21 @@ class CStoreSharpPC1211(CStoreBase):
         # Add the filename. This is a strange format. The max 7-byte
         # filename is sent in reverse byte-order and with reversed
         # nibbles and terminated with 0x5f.
-        fdata = deque()
+        fdata = bytearray(7)
         fname = fname[0:7]
-        for c in fname:
+        for i, c in enumerate(fname):
             if c not in self.TOKENS_T2B:
                 raise CStoreException("cannot encode filename character "
                                       + "'{0}'".format(c))
-            fdata.insert(0, self.TOKENS_T2B[c])
-        while len(fdata) < 7:
-            fdata.insert(0, 0x00)
-        for b in fdata:
-            data.append(((b & 0xf0) >> 4) | ((b & 0x0f) << 4))
+            fdata[6 - i] = self.TOKENS_T2B[c]
+        data.extend(pc1211_swap_nibbles(fdata))
         data.append(0x5f)
 
         # Now process all the program lines
-        re_line     = re.compile("(\d+):(.*)")
-        re_string   = re.compile("(\"[^\"]*\")\s*(.*)")
-        re_string_c = re.compile("(.)(.*)|(|E)(.*)")
-        re_keyword  = re.compile("([A-Z][A-Z]+)\s*(.*)")
-        re_hex      = re.compile("(\[[0-9a-fA-F]+\])(.*)")
-        re_special  = re.compile("(\|E|>=|<=|<>)(.*)")
-        re_char     = re.compile("([^\s])\s*(.*)")
-
         for line in lines:
             # Separate the line number from the rest of it
-            m = re_line.match(line)
+            line = line.upper()
+            m = _RE_LINE.match(line)
             if not m:
                 raise CStoreException("cannot parse '{0}'".format(line))
             # Encode the line number into the byte data as Ennn
@@ -280,69 +308,75 @@ class CStoreSharpPC1211(CStoreBase):
             data.append(int(lno[2:4], 16))
 
             line = m.group(2)
-
-            while len(line) > 0:
-                # First we try to parse keywords (we don't support
-                # the abbreviated dot notations at this point).
-                m = re_keyword.match(line)
-                if m and (m.group(1) + ' ') in self.TOKENS_T2B:
-                    data.append(self.TOKENS_T2B[m.group(1) + ' '])
-                    line = m.group(2)
+            pos = 0
+            end = len(line)
+
+            while pos < end:
+                # Most tokens are single characters that cannot start
+                # anything longer. Take those without the regex.
+                tok = line[pos]
+                if tok in self.TOKENS_T2B_CHAR:
+                    data.append(self.TOKENS_T2B_CHAR[tok])
+                    pos += 1
+                    while pos < end and line[pos].isspace():
+                        pos += 1
                     continue
-                
-                # Next we try to match a double quoted string.
-                m = re_string.match(line)
-                if m:
-                    s = m.group(1)
-                    while len(s) > 0:
-                        mm = re_string_c.match(s)
-                        if mm:
-                            if mm.group(1) in self.TOKENS_T2B:
-                                data.append(self.TOKENS_T2B[mm.group(1)])
-                            else:
-                                raise CStoreException("unsupported string "
-                                        + "character "
-                                        + "'{0}'".format(mm.group(1))
-                                        + " in '" + s + "'")
-                            s = mm.group(2)
-                    line = m.group(2)
+
+                m = _RE_TOKEN.match(line, pos)
+                if m is None:
+                    # This we cannot make any sense of any more
+                    raise CStoreException("failed to parse "
+                                          + "'{0}".format(line[pos:]))
+                kind = m.lastindex
+                tok = m.group(kind)
+
+                if kind == _TOK_KEYWORD:
+                    # First we try to parse keywords (we don't support
+                    # the abbreviated dot notations at this point).
+                    # Letters that don't form a keyword are taken one
+                    # at a time as single characters.
+                    if (tok + ' ') in self.TOKENS_T2B:
+                        data.append(self.TOKENS_T2B[tok + ' '])
+                        pos = m.end()
+                        continue
+                    tok = tok[0]
+                    nextpos = pos + 1
+
+                elif kind == _TOK_STRING:
+                    # A double quoted string is encoded character by
+                    # character, including the quotes.
+                    try:
+                        data.extend(map(self.TOKENS_T2B.__getitem__, tok))
+                    except KeyError as ex:
+                        c = ex.args[0]
+                        raise CStoreException("unsupported string "
+                                + "character "
+                                + "'{0}'".format(c)
+                                + " in '" + tok[tok.index(c):] + "'")
+                    pos = m.end()
                     continue
-                
-                # Match HEX representation
-                # print("checking '" + line + "'", file = sys.stderr)
-                m = re_hex.match(line)
-                if m:
-                    val = int(m.group(1)[1:-1], 16)
-                    # raise Exception("got {0} = {1}".format(m.group(1), val))
+
+                elif kind == _TOK_HEX:
+                    # HEX representation of a byte
+                    val = int(tok[1:-1], 16)
+                    if val > 0xff:
+                        raise CStoreException("hex value "
+                                + "'{0}' is not a byte".format(tok))
                     data.append(val)
-                    line = m.group(2)
+                    pos = m.end()
                     continue
 
-                # Special characters, like |E (for the exponent part of a
-                # number.
-                m = re_special.match(line)
-                if m:
-                    if m.group(1) in self.TOKENS_T2B:
-                        data.append(self.TOKENS_T2B[m.group(1)])
-                        line = m.group(2)
-                        continue
-                    else:
-                        raise CStoreException("unsupported character "
-                                + "'{0}'".format(m.group(1)))
-
-                # Finally anything left must be a single character.
-                m = re_char.match(line)
-                if m:
-                    if m.group(1) in self.TOKENS_T2B:
-                        data.append(self.TOKENS_T2B[m.group(1)])
-                        line = m.group(2)
-                        continue
-                    else:
-                        raise CStoreException("unsupported character "
-                                + "'{0}'".format(m.group(1)))
+                else:
+                    # Special characters, like |E (for the exponent part
+                    # of a number), and anything else must be a single
+                    # character.
+                    nextpos = m.end()
 
-                # This we cannot make any sense of any more
-                raise CStoreException("failed to parse '{0}".format(line))
+                if tok not in self.TOKENS_T2B:
+                    raise CStoreException("unsupported character "
+                            + "'{0}'".format(tok))
+                data.append(self.TOKENS_T2B[tok])
+                pos = nextpos
 
             # Add the line terminator 0x00
             data.append(0x00)
@@ -473,3 +507,19 @@ class CStoreSharpPC1211(CStoreBase):
         0xde:   'RETURN ',
         0xdd:   'USING ',
     }
+
+    # The byte->text token for every possible byte value. Bytes without
+    # a mnemonic are shown in their HEX representation.
+    TOKENS_B2T_TABLE = tuple(map(TOKENS_B2T.get, range(256),
+                                 ("[{0:02X}]".format(b) for b in range(256))))
+
+    # The text->byte token table is the reverse of the byte->text one
+    TOKENS_T2B = {v.upper(): k for k, v in TOKENS_B2T.items()}
+    # Add convenience tokens for text input
+    TOKENS_T2B['SQRT '] = 0x1a
+
+    # The single character tokens that can never be the start of a
+    # keyword, string, HEX byte or two character symbol.
+    TOKENS_T2B_CHAR = {k: v for k, v in TOKENS_T2B.items()
+                       if len(k) == 1 and not k.isspace()
+                       and k not in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ"[|<>'}
@@ -2,8 +2,6 @@
 # cstore_sharp_pc1211_res
 # ----
 
-from collections import deque
-from itertools import islice
 import re
 
 from cassette_store.cstore_base import *
@@ -11,36 +9,44 @@ from cassette_store.cstore_sharp_pc1211 import *
 
 CSTORE_PC1211_PROG  = 0x80
 
+# Patterns for the reserved key text format: the header and a single
+# token on a reserved key line. A token is a run of letters that may be
+# a keyword, a double quoted string, the |E exponent symbol or any other
+# single character. Keywords, strings and single characters swallow the
+# whitespace following them.
+_RE_HEADER = re.compile(r'^RESERVED\s*"([^"]+)"$')
+_RE_TOKEN = re.compile(r'([A-Z][A-Z]+)\s*'
+                       r'|("[^"]*")\s*'
+                       r'|(\|E)'
+                       r'|(\S)\s*')
+_TOK_KEYWORD = 1
+_TOK_STRING = 2
+
 # ----
 # CStoreSharpPC1211Res
 #
 #   Implementation of the Sharp PC-1211 Reserved Keys
 # ----
 class CStoreSharpPC1211Res(CStoreSharpPC1211):
-    def __init__(self, fname = None, mode = 'r', gain = None, sinc = None,
-                 debug = False):
-        # Build the text->byte token table by reversing the byte->text one
-        self.RESKEYS_T2B = {self.RESKEYS_B2T[b]: b
-                            for b in self.RESKEYS_B2T}
-
-        # Let the superclass handle the rest.
-        super().__init__(fname, 
-                         mode       = mode,
-                         gain       = gain,
-                         debug      = debug)
-
     def _write_data(self, data):
         # Behaves slightly different than CStoreSharpPC1211. There is
         # no special handling of line-numbers needed because no NUL
         # byte can occur inside of the reserved key data (only as pad
-        # bytes at the end).
-        bytegen = self._write_byte_generator(data)
-        for b in bytegen:
-            if b == CSTORE_PC1211_PROG:
+        # bytes at the end). Everything up to the next ident byte is
+        # written in one go.
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if data[pos] == CSTORE_PC1211_PROG:
                 self.ident = CSTORE_PC1211_PROG
-                self._write_filename(bytegen)
+                self._write_filename(iter(data[pos + 1:pos + 9]))
+                pos += 9
             else:
-                self._write_byte(b)
+                nextpos = data.find(CSTORE_PC1211_PROG, pos)
+                if nextpos < 0:
+                    nextpos = end
+                self._write_bytes(data[pos:nextpos])
+                pos = nextpos
         self._write_ones(0.5)
 
     def bytes2text(self, data):
@@ -53,46 +59,44 @@ class CStoreSharpPC1211Res(CStoreSharpPC1211):
     def _resbytes2text(self, data):
         # The first 8-byte record (after the 0x80 ident) contains the
         # filename.
-        fname = ""
-        for i in range(7, 0, -1):
-            b = ((data[i] & 0xf0) >> 4) | ((data[i] & 0x0f) << 4)
-            if b != 0x00:
-                fname += self._progbyte2token(b)
-        text = 'RESERVED "{0}"\n'.format(fname)
-
-        # From here on we expect reserved key entries
-        resdata = deque()
-        resdata.extend(data[9:])
-
-        while resdata[0] != 0xf0 and resdata[0] != 0x00:
+        fname = ''.join(map(self.TOKENS_B2T_TABLE.__getitem__,
+                            pc1211_swap_nibbles(bytes(data[7:0:-1]))
+                            .replace(b'\x00', b'')))
+        text = ['RESERVED "{0}"\n'.format(fname)]
+
+        # From here on we expect reserved key entries. We walk the data
+        # with an index. The positions of all bytes that end an entry
+        # are marked with 0x01 in stops.
+        stops = data.translate(self.RESKEYS_STOP_TABLE)
+        pos = 9
+        while data[pos] != 0xf0 and data[pos] != 0x00:
             # Reserved key entries start with the reskey token
-            key = resdata.popleft()
+            key = data[pos]
+            pos += 1
             if key not in self.RESKEYS_B2T:
                 raise CStoreException("unknown reserved key token "
                                       + "0x{0:02x}".format(key))
-            text += self.RESKEYS_B2T[key]
+            text.append(self.RESKEYS_B2T[key])
             
             # Entries end when the next entry starts, we encounter a NUL
             # byte or the EOF marker.
-            while (resdata[0] != 0x00 and resdata[0] != 0xf0
-                   and resdata[0] not in self.RESKEYS_B2T):
-                text += self._progbyte2token(resdata.popleft())
-            text += '\n'
+            end = stops.find(0x01, pos)
+            if end < 0:
+                raise CStoreException("reserved key "
+                        + "'{0}' has no end".format(self.RESKEYS_B2T[key]))
+            text.append(''.join(map(self.TOKENS_B2T_TABLE.__getitem__,
+                                    data[pos:end])))
+            text.append('\n')
+            pos = end
         
-        return text
-
-    def _progbyte2token(self, byte):
-        if byte in self.TOKENS_B2T:
-            return self.TOKENS_B2T[byte]
-        else:
-            return "[{0:02X}]".format(byte)
+        return ''.join(text)
 
     def text2bytes(self, txt):
         # Split the text into lines and determine from the first
         # line what to do.
         lines = txt.upper().strip().split('\n')
 
-        m = re.match('^RESERVED\s*"([^"]+)"$', lines[0].strip())
+        m = _RE_HEADER.match(lines[0].strip())
         if m:
             data = self._restext2bytes(m.group(1), lines[1:])
         else:
@@ -102,7 +106,10 @@ class CStoreSharpPC1211Res(CStoreSharpPC1211):
         return data
         
     def _restext2bytes(self, fname, lines):
-        data = deque()
+        data = bytearray()
+        tokens = self.TOKENS_T2B
+        reskeys = self.RESKEYS_T2B
+        chars = self.TOKENS_T2B_CHAR
 
         # Start with the PC-1211 Program Ident (0x80)
         data.append(CSTORE_PC1211_PROG)
@@ -110,98 +117,93 @@ class CStoreSharpPC1211Res(CStoreSharpPC1211):
         # Add the filename. This is a strange format. The max 7-byte
         # filename is sent in reverse byte-order and with reversed
         # nibbles and terminated with 0x5f.
-        fdata = deque()
+        fdata = bytearray(7)
         fname = fname[0:7]
-        for c in fname:
-            if c not in self.TOKENS_T2B:
+        for i, c in enumerate(fname):
+            if c not in tokens:
                 raise CStoreException("cannot encode filename character "
                                       + "'{0}'".format(c))
-            fdata.insert(0, self.TOKENS_T2B[c])
-        while len(fdata) < 7:
-            fdata.insert(0, 0x00)
-        for b in fdata:
-            data.append(((b & 0xf0) >> 4) | ((b & 0x0f) << 4))
+            fdata[6 - i] = tokens[c]
+        data.extend(pc1211_swap_nibbles(fdata))
         data.append(0x5f)
 
         # Now process all the reserved key lines
-        re_line     = re.compile("(\d+):(.*)")
-        re_string   = re.compile("(\"[^\"]*\")\s*(.*)")
-        re_string_c = re.compile("(.)(.*)|(|E)(.*)")
-        re_keyword  = re.compile("([A-Z][A-Z]+)\s*(.*)")
-        re_special  = re.compile("(\|E)(.*)")
-        re_char     = re.compile("([^\s])\s*(.*)")
-
         for line in lines:
             # Process the reserved key token at the beginning of the line
-            key = line[0:2]
-            if key not in self.RESKEYS_T2B:
+            b = reskeys.get(line[0:2])
+            if b is None:
                 raise CStoreException("unknown reserved key "
-                                      + "'{0}'".format(key))
-            data.append(self.RESKEYS_T2B[key])
-            line = line[2:]
-
-            while len(line) > 0:
-                # First we try to parse keywords (we don't support
-                # the abbreviated dot notations at this point).
-                m = re_keyword.match(line)
-                if m and (m.group(1) + ' ') in self.TOKENS_T2B:
-                    data.append(self.TOKENS_T2B[m.group(1) + ' '])
-                    line = m.group(2)
-                    continue
-                
-                # Next we try to match a double quoted string.
-                m = re_string.match(line)
-                if m:
-                    s = m.group(1)
-                    while len(s) > 0:
-                        mm = re_string_c.match(s)
-                        if mm:
-                            if mm.group(1) in self.TOKENS_T2B:
-                                data.append(self.TOKENS_T2B[mm.group(1)])
-                            else:
-                                raise CStoreException("unsupported string "
-                                        + "character "
-                                        + "'{0}'".format(mm.group(1)))
-                            s = mm.group(2)
-                    line = m.group(2)
+                                      + "'{0}'".format(line[0:2]))
+            data.append(b)
+
+            pos = 2
+            end = len(line)
+
+            while pos < end:
+                # Most tokens are single characters that cannot start
+                # anything longer. Take those without the regex.
+                tok = line[pos]
+                if tok in chars:
+                    data.append(chars[tok])
+                    pos += 1
+                    while pos < end and line[pos].isspace():
+                        pos += 1
                     continue
-                
-                # Special characters, like |E (for the exponent part of a
-                # number.
-                m = re_special.match(line)
-                if m:
-                    if m.group(1) in self.TOKENS_T2B:
-                        data.append(self.TOKENS_T2B[m.group(1)])
-                        line = m.group(2)
-                        continue
-                    else:
-                        raise CStoreException("unsupported character "
-                                + "'{0}'".format(m.group(1)))
-
-                # Finally anything left must be a single character.
-                m = re_char.match(line)
-                if m:
-                    if m.group(1) in self.TOKENS_T2B:
-                        data.append(self.TOKENS_T2B[m.group(1)])
-                        line = m.group(2)
+
+                m = _RE_TOKEN.match(line, pos)
+                if m is None:
+                    # This we cannot make any sense of any more
+                    raise CStoreException("failed to parse "
+                                          + "'{0}".format(line[pos:]))
+                kind = m.lastindex
+                tok = m.group(kind)
+
+                if kind == _TOK_KEYWORD:
+                    # First we try to parse keywords (we don't support
+                    # the abbreviated dot notations at this point).
+                    # Letters that don't form a keyword are taken one
+                    # at a time as single characters.
+                    b = tokens.get(tok + ' ')
+                    if b is not None:
+                        data.append(b)
+                        pos = m.end()
                         continue
-                    else:
-                        raise CStoreException("unsupported character "
-                                + "'{0}'".format(m.group(1)))
+                    tok = tok[0]
+                    nextpos = pos + 1
+
+                elif kind == _TOK_STRING:
+                    # A double quoted string is encoded character by
+                    # character, including the quotes.
+                    try:
+                        data.extend(map(tokens.__getitem__, tok))
+                    except KeyError as ex:
+                        raise CStoreException("unsupported string "
+                                + "character "
+                                + "'{0}'".format(ex.args[0]))
+                    pos = m.end()
+                    continue
 
-                # This we cannot make any sense of any more
-                raise CStoreException("failed to parse '{0}".format(line))
+                else:
+                    # Special characters, like |E (for the exponent part
+                    # of a number), and anything else must be a single
+                    # character.
+                    nextpos = m.end()
+
+                if tok not in tokens:
+                    raise CStoreException("unsupported character "
+                            + "'{0}'".format(tok))
+                data.append(tokens[tok])
+                pos = nextpos
 
         # Pad NUL bytes at the end
-        while len(data) < 57:
-            data.append(0x00)
+        data.extend(b'\x00' * (57 - len(data)))
 
         # Finally add the end-of-program marker 0xf0
         data.append(0xf0)
 
         if len(data) != 58:
-            raise CStoreException("reserved key data length is", len(data),
-                                  "- must be 58")
+            raise CStoreException("reserved key data length is "
+                                  + "{0} - must be 58".format(len(data)))
 
         return data
 
@@ -226,3 +228,12 @@ class CStoreSharpPC1211Res(CStoreSharpPC1211):
         0xf8:   'X:',
         0xfa:   'Z:',
     }
+
+    # The text->byte reserved key table is the reverse of the byte->text one
+    RESKEYS_T2B = {v: k for k, v in RESKEYS_B2T.items()}
+
+    # 1 for all bytes that end a reserved key entry (the start of the
+    # next entry, a NUL byte or the EOF marker), 0 for all others. This
+    # is used as a bytes.translate() table to mark those bytes.
+    RESKEYS_STOP_TABLE = bytes(map((RESKEYS_B2T.keys() | {0x00, 0xf0})
+                                   .__contains__, range(256)))
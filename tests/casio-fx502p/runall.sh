@@ -1,3 +1,4 @@
 #!/bin/sh
 
 ./runtest.sh 900 || exit 1
+./runtrunc.sh 900 45 || exit 1
@@ -1,3 +1,4 @@
 #!/bin/sh
 
 ./runtest.sh RES1 || exit 1
+./runtrunc.sh RES1 60 || exit 1
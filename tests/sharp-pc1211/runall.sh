@@ -2,3 +2,4 @@
 
 ./runtest.sh HELLO || exit 1
 ./runtest.sh ANNUITY || exit 1
+./runtrunc.sh HELLO 50 || exit 1
@@ -0,0 +1,67 @@
+#!/bin/sh
+
+if [ $# -ne 2 ] ; then
+	echo "usage: runtrunc.sh TEST PERCENT" >&2
+	exit 2
+fi
+
+rc=0
+mkdir -p tmp
+
+while true ; do
+# Step 1: Cut the recorded .wav file down to PERCENT of its length.
+python3 - input/pc1211-$1.wav tmp/pc1211-$1-trunc.wav $2 <<END
+import sys, wave
+src = wave.open(sys.argv[1], 'rb')
+dst = wave.open(sys.argv[2], 'wb')
+dst.setparams(src.getparams())
+dst.writeframes(src.readframes(src.getnframes() * int(sys.argv[3]) // 100))
+dst.close()
+END
+if [ $? -ne 0 ] ; then
+	rc=1
+	break
+fi
+
+# Step 2: Decoding the truncated .wav file must fail and must not
+# leave an output file behind.
+cmd="cstore pc1211 save -i tmp/pc1211-$1-trunc.wav -o tmp/pc1211-$1-trunc.bas"
+echo "run: $cmd"
+eval $cmd
+if [ $? -eq 0 ] ; then
+	echo "ERROR: truncated input was not detected" >&2
+	rc=1
+	break
+fi
+if [ -e tmp/pc1211-$1-trunc.bas ] ; then
+	echo "ERROR: failed save left an output file" >&2
+	rc=1
+	break
+fi
+
+# Step 3: The same for binary data, which is written while decoding.
+cmd="cstore pc1211 save -b -i tmp/pc1211-$1-trunc.wav -o tmp/pc1211-$1-trunc.bin"
+echo "run: $cmd"
+eval $cmd
+if [ $? -eq 0 ] ; then
+	echo "ERROR: truncated input was not detected" >&2
+	rc=1
+	break
+fi
+if [ "`ls tmp`" != "pc1211-$1-trunc.wav" ] ; then
+	echo "ERROR: failed save left an output file" >&2
+	rc=1
+	break
+fi
+
+break
+done
+
+if [ $rc -eq 0 ] ; then
+	echo "PASS pc1211 truncated test $1"
+	rm -r tmp
+else
+	echo "FAIL pc1211 truncated test $1" >&2
+fi
+echo ""
+exit $rc